@@ -1,13 +1,39 @@
 import pandas as pd
-import psycopg2
-from psycopg2.extras import execute_values
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import psycopg
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Columns of public.metro_source populated from the CSV, in CSV order
+METRO_COLUMNS = [
+    'code', 'product_name', 'quantity', 'brand', 'categories',
+    'ingredients', 'image_url', 'nutriscore_grade', 'energy_100g',
+    'fat_100g', 'saturated_fat_100g', 'proteins_100g',
+    'carbohydrates_100g', 'sugars_100g', 'fiber_100g', 'sodium_100g'
+]
+
+NUMERIC_COLUMNS = [
+    'energy_100g', 'fat_100g', 'saturated_fat_100g', 'proteins_100g',
+    'carbohydrates_100g', 'sugars_100g', 'fiber_100g', 'sodium_100g'
+]
+
+# Explicit Arrow types so the reader skips type inference (and keeps barcodes as text);
+# numeric columns arrive as float64, so no further coercion is needed
+CSV_COLUMN_TYPES = {
+    col: pa.float64() if col in NUMERIC_COLUMNS else pa.string()
+    for col in METRO_COLUMNS
+}
+
+# Postgres types of the metro_staging columns, used for binary COPY
+STAGING_TYPES = ['float8' if col in NUMERIC_COLUMNS else 'text' for col in METRO_COLUMNS]
+
 
 class SimpleMetroImporter:
     def __init__(self, connection_string: str):
@@ -17,127 +43,178 @@ class SimpleMetroImporter:
     def connect(self):
         """Create database connection"""
         try:
-            conn = psycopg2.connect(self.connection_string)
+            conn = psycopg.connect(self.connection_string)
             return conn
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             return None
 
-    def clean_csv_data(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Clean and prepare CSV data for import"""
-        logger.info("Cleaning CSV data...")
-
-        # Replace NaN/empty values with None for proper NULL handling
-        df = df.where(pd.notnull(df), None)
+    def iter_csv_chunks(self, csv_file_path: str, block_size: int = 8 << 20) -> Iterator[pd.DataFrame]:
+        """Stream the CSV as DataFrame chunks, parsing the next one in the background while the caller works"""
+        reader = pacsv.open_csv(
+            csv_file_path,
+            read_options=pacsv.ReadOptions(block_size=block_size),
+            convert_options=pacsv.ConvertOptions(
+                column_types=CSV_COLUMN_TYPES,
+                include_columns=METRO_COLUMNS,
+                include_missing_columns=True,
+                null_values=[''],
+                strings_can_be_null=True
+            )
+        )
+
+        def next_chunk() -> Optional[pd.DataFrame]:
+            batch = next(reader, None)
+            return batch.to_pandas() if batch is not None else None
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(next_chunk)
+            while True:
+                chunk = future.result()
+                if chunk is None:
+                    break
+                future = executor.submit(next_chunk)
+                yield chunk
+
+    def _create_staging_table(self, cur):
+        """Create the metro_staging temp table, dropped at the end of the transaction"""
+        # Fixed text/float8 types keep binary COPY independent of metro_source's declared types;
+        # row_num (not part of the COPY) records file order so duplicate codes resolve to the last row
+        column_defs = ', '.join(f"{col} {col_type}" for col, col_type in zip(METRO_COLUMNS, STAGING_TYPES))
+        cur.execute(f"CREATE TEMP TABLE metro_staging (row_num bigserial, {column_defs}) ON COMMIT DROP")
+
+    def _drop_secondary_indexes(self, cur) -> List[str]:
+        """Drop non-unique indexes on metro_source and return their DDL for recreation"""
+        cur.execute("""
+                    SELECT ix.indexrelid::regclass::text, c.relname, pg_get_indexdef(ix.indexrelid)
+                    FROM pg_index ix
+                    JOIN pg_class c ON c.oid = ix.indexrelid
+                    WHERE ix.indrelid = 'public.metro_source'::regclass
+                      AND NOT ix.indisprimary
+                      AND NOT ix.indisunique
+                    """)
+        indexes = cur.fetchall()
+
+        for index_name, _, _ in indexes:
+            logger.info(f"Dropping index {index_name} for bulk load...")
+            cur.execute(f"DROP INDEX {index_name}")
+
+        # metro_source.code is already covered by its unique key used for ON CONFLICT,
+        # so the old tmp_metro_source_code index is dropped for good rather than rebuilt
+        return [index_def for _, relname, index_def in indexes if relname != 'tmp_metro_source_code']
+
+    def _recreate_indexes(self, cur, index_defs: List[str]):
+        """Recreate indexes previously dropped by _drop_secondary_indexes"""
+        for index_def in index_defs:
+            logger.info(f"Recreating index: {index_def}")
+            cur.execute(index_def)
+
+    def _copy_into_staging(self, cur, df: pd.DataFrame):
+        """Stream a DataFrame into the metro_staging temp table via binary COPY"""
+        # NaN/NA must become None so they are sent as NULL
+        values = df[METRO_COLUMNS].astype(object)
+        rows = values.where(df[METRO_COLUMNS].notna(), None).to_numpy()
+
+        with cur.copy(f"COPY metro_staging ({', '.join(METRO_COLUMNS)}) FROM STDIN WITH (FORMAT BINARY)") as copy:
+            copy.set_types(STAGING_TYPES)
+            for row in map(tuple, rows):
+                copy.write_row(row)
+
+    def import_csv_to_metro_source(self, csv_file_path: str, conn=None) -> bool:
+        """Import CSV data to metro_source table
+
+        If a connection is passed in, the caller owns its transaction and is
+        responsible for committing and closing it.
+        """
+        if not os.path.exists(csv_file_path):
+            logger.error(f"CSV file not found: {csv_file_path}")
+            return False
 
-        # Ensure code column is string and not empty
-        df = df[df['code'].notna() & (df['code'] != '')]
-        df['code'] = df['code'].astype(str)
+        owns_conn = conn is None
+        try:
+            # Connect to database
+            if owns_conn:
+                conn = self.connect()
+                if not conn:
+                    return False
 
-        # Convert numeric columns to proper types
-        numeric_columns = [
-            'energy_100g', 'fat_100g', 'saturated_fat_100g', 'proteins_100g',
-            'carbohydrates_100g', 'sugars_100g', 'fiber_100g', 'sodium_100g'
-        ]
+            cur = conn.cursor()
 
-        for col in numeric_columns:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
+            # Setup statements are pipelined to avoid a round-trip each
+            with conn.pipeline():
+                # Whole import is one transaction; a lost commit just means re-running it
+                cur.execute("SET LOCAL synchronous_commit TO off")
+                cur.execute("SET LOCAL work_mem TO '256MB'")
+                cur.execute("SET LOCAL maintenance_work_mem TO '512MB'")
 
-        logger.info(f"Cleaned data: {len(df)} rows ready for import")
-        return df
+                # Clear existing data
+                logger.info("Clearing existing metro_source data...")
+                cur.execute("TRUNCATE TABLE public.metro_source")
 
-    def import_csv_to_metro_source(self, csv_file_path: str, batch_size: int = 1000) -> bool:
-        """Import CSV data to metro_source table"""
-        if not os.path.exists(csv_file_path):
-            logger.error(f"CSV file not found: {csv_file_path}")
-            return False
+                # Secondary indexes are rebuilt once after the load instead of per row
+                index_defs = self._drop_secondary_indexes(cur)
+                self._create_staging_table(cur)
 
-        try:
-            # Read CSV
+            # Stream CSV chunks into the staging table
             logger.info(f"Reading CSV file: {csv_file_path}")
-            df = pd.read_csv(csv_file_path)
-            logger.info(f"CSV loaded: {len(df)} rows")
-
-            # Clean data
-            df = self.clean_csv_data(df)
+            total_rows = 0
+            for chunk_num, chunk in enumerate(self.iter_csv_chunks(csv_file_path), 1):
+                self._copy_into_staging(cur, chunk)
+                total_rows += len(chunk)
+                logger.info(f"Copied chunk {chunk_num}: {len(chunk)} rows (Total: {total_rows})")
+                del chunk
+
+            # Single upsert from staging into metro_source; rows without a barcode are skipped here,
+            # and a barcode that appears more than once keeps its last row in file order
+            update_columns = [col for col in METRO_COLUMNS if col != 'code']
+            insert_sql = f"""
+            INSERT INTO public.metro_source ({', '.join(METRO_COLUMNS)})
+            SELECT DISTINCT ON (code) {', '.join(METRO_COLUMNS)}
+            FROM metro_staging
+            WHERE code <> ''
+            ORDER BY code, row_num DESC
+            ON CONFLICT (code) DO UPDATE SET
+                {', '.join(f'{col} = EXCLUDED.{col}' for col in update_columns)},
+                created_at = now()
+            """
 
-            # Connect to database
-            conn = self.connect()
-            if not conn:
+            cur.execute(insert_sql)
+            imported_count = cur.rowcount
+            if imported_count == 0:
+                # Don't commit the TRUNCATE: an empty or code-less CSV must not wipe metro_source
+                logger.error(f"No products with a barcode found in {csv_file_path}, keeping existing data")
+                if owns_conn:
+                    conn.rollback()
                 return False
 
-            cur = conn.cursor()
-
-            # Clear existing data
-            logger.info("Clearing existing metro_source data...")
-            cur.execute("DELETE FROM public.metro_source")
-
-            # Prepare data for batch insert
-            columns = [
-                'code', 'product_name', 'quantity', 'brand', 'categories',
-                'ingredients', 'image_url', 'nutriscore_grade', 'energy_100g',
-                'fat_100g', 'saturated_fat_100g', 'proteins_100g',
-                'carbohydrates_100g', 'sugars_100g', 'fiber_100g', 'sodium_100g'
-            ]
-
-            # Process in batches
-            total_rows = len(df)
-            for i in range(0, total_rows, batch_size):
-                batch_df = df.iloc[i:i + batch_size]
-
-                # Convert to list of tuples
-                batch_data = []
-                for _, row in batch_df.iterrows():
-                    row_data = tuple(row[col] if col in row and pd.notna(row[col]) else None for col in columns)
-                    batch_data.append(row_data)
-
-                # Execute batch insert
-                insert_sql = f"""
-                INSERT INTO public.metro_source ({', '.join(columns)})
-                VALUES %s
-                ON CONFLICT (code) DO UPDATE SET
-                    product_name = EXCLUDED.product_name,
-                    quantity = EXCLUDED.quantity,
-                    brand = EXCLUDED.brand,
-                    categories = EXCLUDED.categories,
-                    ingredients = EXCLUDED.ingredients,
-                    image_url = EXCLUDED.image_url,
-                    nutriscore_grade = EXCLUDED.nutriscore_grade,
-                    energy_100g = EXCLUDED.energy_100g,
-                    fat_100g = EXCLUDED.fat_100g,
-                    saturated_fat_100g = EXCLUDED.saturated_fat_100g,
-                    proteins_100g = EXCLUDED.proteins_100g,
-                    carbohydrates_100g = EXCLUDED.carbohydrates_100g,
-                    sugars_100g = EXCLUDED.sugars_100g,
-                    fiber_100g = EXCLUDED.fiber_100g,
-                    sodium_100g = EXCLUDED.sodium_100g,
-                    created_at = now()
-                """
-
-                execute_values(cur, insert_sql, batch_data)
+            with conn.pipeline():
+                self._recreate_indexes(cur, index_defs)
+            if owns_conn:
                 conn.commit()
 
-                logger.info(
-                    f"Imported batch {i // batch_size + 1}: {len(batch_data)} rows (Total: {min(i + batch_size, total_rows)}/{total_rows})")
-
-            logger.info(f"Successfully imported {total_rows} products to metro_source table")
+            logger.info(f"Successfully imported {imported_count} products to metro_source table")
             return True
 
         except Exception as e:
             logger.error(f"Error importing CSV: {e}")
-            if conn:
+            if owns_conn and conn:
                 conn.rollback()
             return False
         finally:
-            if conn:
+            if owns_conn and conn:
                 conn.close()
 
-    def update_food_item_sources(self) -> bool:
-        """Update food_item_sources table with Metro data - optimized version"""
-        conn = self.connect()
-        if not conn:
-            return False
+    def update_food_item_sources(self, conn=None) -> bool:
+        """Update food_item_sources table with Metro data - optimized version
+
+        If a connection is passed in, the caller owns its transaction and is
+        responsible for committing and closing it.
+        """
+        owns_conn = conn is None
+        if owns_conn:
+            conn = self.connect()
+            if not conn:
+                return False
 
         try:
             cur = conn.cursor()
@@ -145,60 +222,42 @@ class SimpleMetroImporter:
             # Set longer timeout for large operations
             cur.execute("SET statement_timeout = '10min'")
 
-            logger.info("Creating temporary indexes for better performance...")
-
-            # Create temporary index on metro_source.code if not exists
-            cur.execute("""
-                        CREATE INDEX IF NOT EXISTS tmp_metro_source_code
-                            ON public.metro_source(code)
-                        """)
-
-            logger.info("Updating existing records in food_item_sources...")
-
-            # More efficient update query using EXISTS
-            update_sql = """
-                         UPDATE public.food_item_sources
-                         SET sources = array_append(sources, 'metro')
-                         WHERE EXISTS (SELECT 1 \
-                                       FROM public.metro_source m \
-                                       WHERE m.code = food_item_sources.code)
-                           AND NOT ('metro' = ANY (sources)) \
+            logger.info("Upserting Metro codes into food_item_sources...")
+
+            # Single pass over metro_source: insert new codes, tag existing ones with 'metro'.
+            # xmax = 0 only holds for freshly inserted rows, which lets us split the counts.
+            upsert_sql = """
+                         WITH upserted AS (
+                             INSERT INTO public.food_item_sources (code, sources)
+                             SELECT m.code, ARRAY['metro'] ::character varying[]
+                             FROM public.metro_source m
+                             ON CONFLICT (code) DO UPDATE
+                                 SET sources = food_item_sources.sources || ARRAY['metro'] ::character varying[]
+                                 WHERE NOT (food_item_sources.sources @> ARRAY['metro'] ::character varying[])
+                             RETURNING (xmax = 0) AS inserted
+                         )
+                         SELECT COUNT(*) FILTER (WHERE inserted),
+                                COUNT(*) FILTER (WHERE NOT inserted)
+                         FROM upserted \
                          """
 
-            cur.execute(update_sql)
-            updated_count = cur.rowcount
+            cur.execute(upsert_sql)
+            inserted_count, updated_count = cur.fetchone()
             logger.info(f"Updated {updated_count} existing records with 'metro' source")
-            conn.commit()
-
-            logger.info("Inserting new Metro-only records...")
-
-            # More efficient insert using NOT EXISTS
-            insert_sql = """
-                         INSERT INTO public.food_item_sources (code, sources)
-                         SELECT m.code, ARRAY['metro'] ::character varying[]
-                         FROM public.metro_source m
-                         WHERE NOT EXISTS (
-                             SELECT 1 FROM public.food_item_sources fis
-                             WHERE fis.code = m.code
-                             ) \
-                         """
-
-            cur.execute(insert_sql)
-            inserted_count = cur.rowcount
             logger.info(f"Inserted {inserted_count} new records with 'metro' source")
-            conn.commit()
+            if owns_conn:
+                conn.commit()
 
             # Get final statistics
             logger.info("Calculating final statistics...")
 
-            cur.execute("SELECT COUNT(*) FROM public.food_item_sources WHERE 'metro' = ANY(sources)")
-            metro_total = cur.fetchone()[0]
-
-            cur.execute("SELECT COUNT(*) FROM public.food_item_sources WHERE array_length(sources, 1) > 1")
-            both_sources = cur.fetchone()[0]
-
-            cur.execute("SELECT COUNT(*) FROM public.food_item_sources")
-            total_products = cur.fetchone()[0]
+            cur.execute("""
+                        SELECT COUNT(*),
+                               COUNT(*) FILTER (WHERE 'metro' = ANY (sources)),
+                               COUNT(*) FILTER (WHERE array_length(sources, 1) > 1)
+                        FROM public.food_item_sources
+                        """)
+            total_products, metro_total, both_sources = cur.fetchone()
 
             logger.info(f"Final statistics:")
             logger.info(f"  - Total unique products: {total_products}")
@@ -209,24 +268,41 @@ class SimpleMetroImporter:
 
         except Exception as e:
             logger.error(f"Error updating food_item_sources: {e}")
-            conn.rollback()
+            if owns_conn:
+                conn.rollback()
             return False
         finally:
-            conn.close()
+            if owns_conn:
+                conn.close()
 
     def run_import(self, csv_file_path: str) -> bool:
         """Run the complete import process"""
         logger.info("Starting Metro data import process...")
 
-        # Step 1: Import CSV data to metro_source
-        if not self.import_csv_to_metro_source(csv_file_path):
-            logger.error("Failed to import CSV data")
+        # One connection and one transaction for both steps, so the import is atomic
+        conn = self.connect()
+        if not conn:
             return False
 
-        # Step 2: Update food_item_sources
-        if not self.update_food_item_sources():
-            logger.error("Failed to update food_item_sources")
+        try:
+            # Step 1: Import CSV data to metro_source
+            if not self.import_csv_to_metro_source(csv_file_path, conn):
+                logger.error("Failed to import CSV data")
+                conn.rollback()
+                return False
+
+            # Step 2: Update food_item_sources
+            if not self.update_food_item_sources(conn):
+                logger.error("Failed to update food_item_sources")
+                conn.rollback()
+                return False
+
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error during Metro data import: {e}")
             return False
+        finally:
+            conn.close()
 
         logger.info("✅ Metro data import completed successfully!")
         return True
@@ -1,24 +1,211 @@
-import requests
-import json
+import aiohttp
+import asyncio
+import contextlib
+import csv
+import orjson
+import os
+import random
+import re
+import sqlite3
 import time
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
 from typing import List, Dict, Optional, Set
-from urllib.parse import quote
+from urllib.parse import quote, urlencode
+
+
+class _RateLimiter:
+    """Spaces request starts at least min_interval apart, shared by all tasks on the event loop"""
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._next_ok = 0.0
+
+    async def acquire(self):
+        # Reserve the slot before sleeping, so concurrent callers queue up behind each other
+        now = time.monotonic()
+        wait = self._next_ok - now
+        self._next_ok = max(now, self._next_ok) + self.min_interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class _ResponseCache:
+    """SQLite store of raw API response bodies keyed by request URL, so reruns skip the network"""
+
+    def __init__(self, path: str, expire_after: float):
+        self.expire_after = expire_after
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, fetched_at REAL NOT NULL, body BLOB NOT NULL)"
+        )
+
+    def get(self, url: str, allow_stale: bool = False) -> Optional[bytes]:
+        row = self._conn.execute("SELECT fetched_at, body FROM responses WHERE url = ?", (url,)).fetchone()
+        if row and (allow_stale or time.time() - row[0] < self.expire_after):
+            return row[1]
+        return None
+
+    def set(self, url: str, body: bytes):
+        self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (url, time.time(), body))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+class _ProductWriter:
+    """Streams products to the output CSV and, in row groups, to a typed Parquet copy next to it
+
+    Both are written to '.part' files that only replace the real outputs on publish(), so a failed
+    run never clobbers the previous output; after a crash the partial files are left on disk.
+    """
+
+    ROW_GROUP_SIZE = 10_000
+
+    def __init__(self, filename: str, columns: List[str], schema: pa.Schema, stat_columns: List[str],
+                 logger: logging.Logger):
+        self.schema = schema
+        self.logger = logger
+        self.count = 0
+        self.filled = dict.fromkeys(stat_columns, 0)  # Non-empty values per column, for coverage stats
+
+        self.csv_path = filename
+        self._csv_file = open(self.csv_path + '.part', 'w', encoding='utf-8', newline='')
+        self._csv_writer = csv.DictWriter(self._csv_file, fieldnames=columns, extrasaction='ignore', lineterminator='\n')
+        self._csv_writer.writeheader()
+
+        self.parquet_path = os.path.splitext(filename)[0] + '.parquet'
+        self._parquet_writer = pq.ParquetWriter(self.parquet_path + '.part', schema, compression='zstd')
+        self._parquet_ok = True
+        self._pending: List[Dict] = []
+
+    def write(self, product: Dict):
+        self._csv_writer.writerow(product)
+        self.count += 1
+        for column in self.filled:
+            if product.get(column) not in (None, ''):
+                self.filled[column] += 1
+
+        if self._parquet_writer:
+            self._pending.append(product)
+            if len(self._pending) >= self.ROW_GROUP_SIZE:
+                self._write_row_group()
+
+    def flush(self):
+        """Push written CSV rows to disk; the Parquet copy is only readable once closed"""
+        self._csv_file.flush()
+
+    def _write_row_group(self):
+        try:
+            self._parquet_writer.write_table(pa.Table.from_pylist(self._pending, schema=self.schema))
+        except (pa.ArrowException, OSError) as e:
+            # The CSV is the primary output; carry on without the Parquet copy
+            self.logger.error(f"Failed to write {self.parquet_path}, continuing with CSV only: {e}")
+            with contextlib.suppress(pa.ArrowException, OSError):
+                self._parquet_writer.close()
+                os.remove(self.parquet_path + '.part')
+            self._parquet_writer = None
+            self._parquet_ok = False
+        self._pending = []
+
+    def close(self):
+        if self._parquet_writer and self._pending:
+            self._write_row_group()
+        if self._parquet_writer:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        self._csv_file.close()
+
+    def publish(self):
+        """Move the closed '.part' files into place over any previous output"""
+        os.replace(self.csv_path + '.part', self.csv_path)
+        if self._parquet_ok:
+            os.replace(self.parquet_path + '.part', self.parquet_path)
+
+    def discard(self):
+        """Remove the closed '.part' files, keeping any previous output"""
+        for path in (self.csv_path, self.parquet_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path + '.part')
 
 
 class MetroProductScraper:
-    def __init__(self, delay: float = 1.5):
+    # Responses worth retrying: rate limiting and gateway/availability errors
+    RETRY_STATUSES = {429, 502, 503, 504}
+    RETRY_BASE_DELAY = 1.0
+    RETRY_MAX_DELAY = 30.0
+
+    # IDs per betty-articles request: start here, grow to the max once a full batch comes back complete
+    DETAILS_BATCH_SIZE = 50
+    DETAILS_MAX_BATCH_SIZE = 100
+    DETAILS_MAX_URL_LENGTH = 7000  # Stay clear of server-side URL length limits
+    DETAILS_SPLIT_STATUSES = frozenset((400, 414))  # Rejections that mean the batch itself is too big
+
+    # Output schema, matching public.metro_source
+    CSV_COLUMNS = [
+        'code', 'product_name', 'quantity', 'brand', 'categories',
+        'ingredients', 'image_url', 'nutriscore_grade', 'energy_100g',
+        'fat_100g', 'saturated_fat_100g', 'proteins_100g',
+        'carbohydrates_100g', 'sugars_100g', 'fiber_100g', 'sodium_100g'
+    ]
+    NUMERIC_COLUMNS = [
+        'energy_100g', 'fat_100g', 'saturated_fat_100g', 'proteins_100g',
+        'carbohydrates_100g', 'sugars_100g', 'fiber_100g', 'sodium_100g'
+    ]
+
+    # Typed output schema; nutrients stay float64 to match the float8 columns they are imported into
+    _METRO_SCHEMA = pa.schema({**dict.fromkeys(CSV_COLUMNS, pa.string()), **dict.fromkeys(NUMERIC_COLUMNS, pa.float64())})
+
+    # Columns whose coverage is logged after saving -> description
+    _STAT_COLUMNS = {'energy_100g': 'nutritional data', 'ingredients': 'ingredients', 'image_url': 'images'}
+
+    # Ingredient statement leafs worth keeping, and labels that are only markup
+    _INGREDIENT_META_INFO = frozenset(('Contains', ''))
+    _INGREDIENT_STOPWORDS = frozenset(('INGREDIENTS', '(', ')'))
+
+    # (nutrient column, row label keywords, unit), in output column order
+    _NUTRIENT_SPEC = (
+        ('energy_100g', ('енергийна стойност',), 'kcal'),
+        ('fat_100g', ('мазнини',), 'g'),
+        ('saturated_fat_100g', ('наситени',), 'g'),
+        ('proteins_100g', ('белтъци',), 'g'),
+        ('carbohydrates_100g', ('въглехидрати',), 'g'),
+        ('sugars_100g', ('захари',), 'g'),
+        ('fiber_100g', ('влакна', 'fiber'), 'g'),
+        ('sodium_100g', ('sodium',), 'mg'),
+    )
+    # All keywords compiled into one matcher, so each row label is scanned once for every nutrient.
+    # The lookahead makes matches zero-width, so overlapping keywords are all reported
+    _NUTRIENT_BY_KEYWORD = {keyword: (key, unit) for key, keywords, unit in _NUTRIENT_SPEC for keyword in keywords}
+    _NUTRIENT_PATTERN = re.compile('(?=(%s))' % '|'.join(map(re.escape, _NUTRIENT_BY_KEYWORD)))
+
+    def __init__(self, delay: float = 1.5, max_concurrency: int = 10, max_retries: int = 3,
+                 cache_path: Optional[str] = "metro_cache.sqlite", cache_expire_after: float = 86400):
         self.base_url = "https://shop.metro.bg"
         self.delay = delay
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.cache_path = cache_path  # None disables the response cache
+        self.cache_expire_after = cache_expire_after
 
-        self.session = requests.Session()
-        self.session.headers.update({
+        self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             'Accept': 'application/json',
             'Accept-Language': 'bg-BG,bg;q=0.9,en;q=0.8',
             'Referer': 'https://shop.metro.bg/'
-        })
+        }
+
+        # Created per run inside the event loop, see open_session()
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.BoundedSemaphore] = None
+        self._cache: Optional[_ResponseCache] = None
+
+        # Same aggregate rate as each concurrency slot sleeping `delay` per request, without the extra waits
+        self._limiter = _RateLimiter(delay / max_concurrency)
 
         # Setup logging
         logging.basicConfig(
@@ -31,27 +218,102 @@ class MetroProductScraper:
         )
         self.logger = logging.getLogger(__name__)
 
-    def _make_request(self, url: str, params: Dict = None) -> Optional[Dict]:
-        """Make API request with error handling and rate limiting"""
-        try:
-            time.sleep(self.delay)
-            response = self.session.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            self.logger.error(f"Request failed for {url}: {e}")
-            return None
-        except json.JSONDecodeError as e:
-            self.logger.error(f"JSON decode error for {url}: {e}")
+    async def open_session(self):
+        """Create the shared HTTP session and concurrency limit for a scraping run"""
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            # Large keep-alive pool so every slot reuses a warm TLS connection to shop.metro.bg
+            connector=aiohttp.TCPConnector(
+                limit=max(32, self.max_concurrency),
+                limit_per_host=max(32, self.max_concurrency),
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            ),
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+        self._semaphore = asyncio.BoundedSemaphore(self.max_concurrency)
+        if self.cache_path:
+            self._cache = _ResponseCache(self.cache_path, self.cache_expire_after)
+
+    async def close_session(self):
+        """Close the shared HTTP session and response cache"""
+        if self.session:
+            await self.session.close()
+            self.session = None
+        if self._cache:
+            self._cache.close()
+            self._cache = None
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Exponential backoff with jitter, honouring a numeric Retry-After header"""
+        if retry_after and retry_after.isdigit():
+            return min(self.RETRY_MAX_DELAY, float(retry_after))
+        delay = min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * (2 ** attempt))
+        return delay * (1 + random.uniform(0, 0.5))
+
+    async def _fetch_json(self, url: str, params=None, raise_statuses: frozenset = frozenset()) -> Optional[Dict]:
+        """Make API request with caching, error handling, retries and rate limiting
+
+        HTTP errors with a status in raise_statuses are raised to the caller instead of logged.
+        """
+        cache_key = f"{url}?{urlencode(params or [])}"
+        if self._cache:
+            body = self._cache.get(cache_key)
+            if body is not None:
+                return orjson.loads(body)
+
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                try:
+                    await self._limiter.acquire()
+                    async with self.session.get(url, params=params) as response:
+                        if response.status in self.RETRY_STATUSES:
+                            retry_after = response.headers.get('Retry-After')
+                        response.raise_for_status()
+                        body = await response.read()
+                        data = orjson.loads(body)
+                        if self._cache:
+                            self._cache.set(cache_key, body)
+                        return data
+                except aiohttp.ClientResponseError as e:
+                    if e.status in raise_statuses:
+                        raise
+                    if e.status not in self.RETRY_STATUSES:
+                        self.logger.error(f"Request failed for {url}: {e}")
+                        return self._stale_response(cache_key, url)
+                    error = e
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = e
+                except orjson.JSONDecodeError as e:
+                    # Usually a truncated response; worth another try
+                    error = e
+
+                if attempt == self.max_retries:
+                    self.logger.error(f"Request failed for {url} after {attempt + 1} attempts: {str(error) or repr(error)}")
+                    return self._stale_response(cache_key, url)
+
+                retry_delay = self._retry_delay(attempt, retry_after)
+                self.logger.warning(
+                    f"Attempt {attempt + 1} failed for {url}: {str(error) or repr(error)}; retrying in {retry_delay:.1f}s")
+                await asyncio.sleep(retry_delay)
+
+    def _stale_response(self, cache_key: str, url: str) -> Optional[Dict]:
+        """Fall back to an expired cached response, if there is one, when the API keeps failing"""
+        body = self._cache.get(cache_key, allow_stale=True) if self._cache else None
+        if body is None:
             return None
+        self.logger.warning(f"Using stale cached response for {url}")
+        return orjson.loads(body)
 
-    def convert_variant_to_article_id(self, variant_id: str) -> str:
+    @staticmethod
+    def convert_variant_to_article_id(variant_id: str) -> str:
         """Convert variant ID (BTY-X2945500032) to article ID (BTY-X294550)"""
         if len(variant_id) > 4 and variant_id[-4:].isdigit():
             return variant_id[:-4]
         return variant_id
 
-    def get_food_subcategories(self) -> List[str]:
+    async def get_food_subcategories(self) -> List[str]:
         """Get all food subcategory paths to bypass pagination limits"""
         self.logger.info("Fetching food subcategories...")
 
@@ -65,29 +327,30 @@ class MetroProductScraper:
             'page': 1,
             'filter': 'category:хранителни-стоки',
             'facets': 'true',
-            'categories': 'true',
-            '__t': int(time.time() * 1000)
+            'categories': 'true'
         }
 
         url = f"{self.base_url}/searchdiscover/articlesearch/search"
-        response = self._make_request(url, params)
+        response = await self._fetch_json(url, params)
 
         categories = []
 
         if response and 'categorytree' in response:
-            def extract_categories(tree_node, current_path=""):
-                """Recursively extract category paths"""
-                if 'children' in tree_node:
-                    for category_id, category_data in tree_node['children'].items():
-                        category_path = category_data.get('urlCategoryPath', '')
-                        if category_path and category_path.startswith('хранителни-стоки'):
-                            categories.append(category_path)
-                            # Recursively process children
-                            extract_categories(category_data, category_path)
-
             # Start with the food category tree
             food_tree = response['categorytree']['children'].get('Food_1622788118100', {})
-            extract_categories(food_tree)
+
+            # Walk the tree iteratively; the same category can hang under several parents,
+            # so each path is collected (and its subtree walked) only once
+            seen = set()
+            stack = [food_tree]
+            while stack:
+                tree_node = stack.pop()
+                for category_id, category_data in tree_node.get('children', {}).items():
+                    category_path = category_data.get('urlCategoryPath', '')
+                    if category_path and category_path.startswith('хранителни-стоки') and category_path not in seen:
+                        seen.add(category_path)
+                        categories.append(category_path)
+                        stack.append(category_data)
 
         # If we couldn't extract subcategories, fall back to main category
         if not categories:
@@ -96,15 +359,14 @@ class MetroProductScraper:
         self.logger.info(f"Found {len(categories)} food categories to scrape")
         return categories
 
-    def get_product_variant_ids_from_category(self, category: str) -> Set[str]:
-        """Get all product variant IDs from a specific category"""
+    async def get_article_ids_from_category(self, category: str) -> Set[str]:
+        """Get all article IDs from a specific category (variant IDs are converted as they arrive)"""
         self.logger.info(f"Fetching products from category: {category}")
 
-        all_variant_ids = set()
-        page = 1
+        url = f"{self.base_url}/searchdiscover/articlesearch/search"
 
-        while True:
-            params = {
+        def page_params(page: int) -> Dict:
+            return {
                 'storeId': '00010',
                 'language': 'bg-BG',
                 'country': 'BG',
@@ -113,119 +375,152 @@ class MetroProductScraper:
                 'page': page,
                 'filter': f'category:{category}',
                 'facets': 'true',
-                'categories': 'true',
-                '__t': int(time.time() * 1000)
+                'categories': 'true'
             }
 
-            url = f"{self.base_url}/searchdiscover/articlesearch/search"
-            response = self._make_request(url, params)
+        # The first page tells us how many pages there are; the rest are fetched concurrently
+        first_response = await self._fetch_json(url, page_params(1))
+        if not first_response or 'resultIds' not in first_response:
+            self.logger.warning(f"Failed to get results for category {category}, page 1")
+            return set()
+
+        total_pages = min(first_response.get('totalPages', 1), 100)  # Safety limit
+        responses = [first_response] + list(await asyncio.gather(
+            *(self._fetch_json(url, page_params(page)) for page in range(2, total_pages + 1))
+        ))
 
+        article_ids = set()
+        for page, response in enumerate(responses, 1):
             if not response or 'resultIds' not in response:
                 self.logger.warning(f"Failed to get results for category {category}, page {page}")
-                break
+                continue
 
             result_ids = response['resultIds']
-            if not result_ids:
-                break
-
-            all_variant_ids.update(result_ids)
+            article_ids.update(map(self.convert_variant_to_article_id, result_ids))
             self.logger.info(
-                f"Category {category}, page {page}: Found {len(result_ids)} products (Category total: {len(all_variant_ids)})")
-
-            # Check if we've reached the last page or hit pagination limit
-            if page >= response.get('totalPages', 1) or page >= 100:  # Safety limit
-                break
+                f"Category {category}, page {page}/{total_pages}: Found {len(result_ids)} products (Category total: {len(article_ids)})")
 
-            page += 1
+        return article_ids
 
-        return all_variant_ids
-
-    def get_all_product_variant_ids(self) -> Set[str]:
-        """Get all food product variant IDs from Metro by scraping each subcategory"""
+    async def get_all_article_ids(self) -> Set[str]:
+        """Get all food product article IDs from Metro by scraping each subcategory"""
         self.logger.info("Starting category-based scraping to get all products...")
 
         # Get all food subcategories
-        categories = self.get_food_subcategories()
-
-        all_variant_ids = set()
-
-        for i, category in enumerate(categories, 1):
-            self.logger.info(f"Processing category {i}/{len(categories)}: {category}")
+        categories = await self.get_food_subcategories()
 
-            try:
-                category_ids = self.get_product_variant_ids_from_category(category)
-                all_variant_ids.update(category_ids)
-                self.logger.info(
-                    f"Category {category}: {len(category_ids)} products (Total unique: {len(all_variant_ids)})")
+        # Categories are scraped concurrently; the semaphore in _fetch_json bounds the request rate
+        results = await asyncio.gather(
+            *(self.get_article_ids_from_category(category) for category in categories),
+            return_exceptions=True
+        )
 
-                # Add delay between categories
-                time.sleep(2)
+        all_article_ids = set()
 
-            except Exception as e:
-                self.logger.error(f"Error processing category {category}: {e}")
+        for i, (category, category_ids) in enumerate(zip(categories, results), 1):
+            if isinstance(category_ids, Exception):
+                self.logger.error(f"Error processing category {category}: {category_ids}")
                 continue
 
-        self.logger.info(f"Finished fetching IDs from all categories. Total unique variant IDs: {len(all_variant_ids)}")
-        return all_variant_ids
+            all_article_ids.update(category_ids)
+            self.logger.info(
+                f"Category {i}/{len(categories)} {category}: {len(category_ids)} products (Total unique: {len(all_article_ids)})")
+
+        self.logger.info(f"Finished fetching IDs from all categories. Total unique article IDs: {len(all_article_ids)}")
+        return all_article_ids
 
-    def get_product_details_batch(self, article_ids: List[str]) -> Optional[Dict]:
+    async def get_product_details_batch(self, article_ids: List[str],
+                                        raise_statuses: frozenset = frozenset()) -> Optional[Dict]:
         """Get product details for multiple article IDs in one request"""
         url = f"{self.base_url}/evaluate.article.v1/betty-articles"
 
-        # Build URL with multiple IDs
-        params = {
-            'country': 'BG',
-            'locale': 'bg-BG',
-            'storeIds': '00010',
-            'details': 'true',
-            '__t': int(time.time() * 1000)
-        }
-
-        # Add multiple IDs as separate parameters
-        param_pairs = []
-        for key, value in params.items():
-            param_pairs.append(f'{key}={value}')
+        # Multiple IDs are sent as repeated 'ids' parameters, encoded by aiohttp
+        params = [
+            ('country', 'BG'),
+            ('locale', 'bg-BG'),
+            ('storeIds', '00010'),
+            ('details', 'true')
+        ]
+        params += [('ids', article_id) for article_id in article_ids]
 
-        for article_id in article_ids:
-            param_pairs.append(f'ids={article_id}')
+        return await self._fetch_json(url, params, raise_statuses)
 
-        full_url = f"{url}?{'&'.join(param_pairs)}"
+    async def get_product_details(self, article_ids: List[str], split: bool = True) -> Dict[str, Dict]:
+        """Get product details keyed by article ID
 
+        A batch the API rejects as too big, or answers only in part, is split in half once. A batch
+        that runs out of retries on rate limiting or server errors is dropped: splitting it would
+        only add load while Metro is already struggling.
+        """
         try:
-            time.sleep(self.delay)
-            response = self.session.get(full_url, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            self.logger.error(f"Error getting product details batch: {e}")
-            return None
+            response = await self.get_product_details_batch(article_ids, self.DETAILS_SPLIT_STATUSES)
+        except aiohttp.ClientResponseError as e:
+            if not split:
+                self.logger.error(f"Dropping batch of {len(article_ids)} products: {e}")
+                return {}
+            self.logger.warning(f"Batch of {len(article_ids)} rejected ({e.status}), retrying as two smaller batches")
+            return await self._split_details(article_ids)
+
+        if not response or 'result' not in response:
+            self.logger.error(f"Dropping batch of {len(article_ids)} products after failed request")
+            return {}
+
+        results = response['result']
+        missing = [article_id for article_id in article_ids if article_id not in results]
+        if missing:
+            self.logger.warning(f"Batch returned {len(results)} of {len(article_ids)} products")
+            if split:
+                results.update(await self._split_details(missing))
+        return results
+
+    async def _split_details(self, article_ids: List[str]) -> Dict[str, Dict]:
+        if len(article_ids) == 1:
+            return await self.get_product_details(article_ids, split=False)
+        half = len(article_ids) // 2
+        parts = await asyncio.gather(
+            self.get_product_details(article_ids[:half], split=False),
+            self.get_product_details(article_ids[half:], split=False)
+        )
+        return {article_id: data for part in parts for article_id, data in part.items()}
 
-    def extract_nutritional_value(self, nutrition_table: Dict, label_keywords: List[str], unit: str = None) -> Optional[
-        float]:
-        """Extract nutritional value from Metro's nutrition table"""
-        if not nutrition_table or 'rows' not in nutrition_table:
-            return None
+    def make_details_batches(self, article_ids: List[str], batch_size: int) -> List[List[str]]:
+        """Split article IDs into batches of at most batch_size, keeping each request URL under the length cap"""
+        base_length = len(f"{self.base_url}/evaluate.article.v1/betty-articles?country=BG&locale=bg-BG&storeIds=00010&details=true")
+        batches = []
+        batch, url_length = [], base_length
+        for article_id in article_ids:
+            id_length = len('&ids=') + len(quote(article_id, safe=''))
+            if batch and (len(batch) >= batch_size or url_length + id_length > self.DETAILS_MAX_URL_LENGTH):
+                batches.append(batch)
+                batch, url_length = [], base_length
+            batch.append(article_id)
+            url_length += id_length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def extract_nutrition(self, nutrition_table: Dict) -> Dict[str, Optional[float]]:
+        """Extract all nutrients from Metro's nutrition table in a single pass over its rows"""
+        nutrition_data = dict.fromkeys(key for key, _, _ in self._NUTRIENT_SPEC)
+        for row in nutrition_table.get('rows', []):
+            cells = row.get('cells')
+            if not cells or not cells[0].get('value'):
+                continue
+            try:
+                value = float(cells[0]['value'])
+            except (ValueError, TypeError):
+                continue
 
-        for row in nutrition_table['rows']:
-            row_label = row.get('rowLabel', '').lower()
-            cells = row.get('cells', [])
-
-            # Check if this row matches our keywords
-            if any(keyword in row_label for keyword in label_keywords):
-                if len(cells) >= 1 and cells[0].get('value'):
-                    try:
-                        value = float(cells[0].get('value', ''))
-                        cell_unit = cells[0].get('unitOfMeasure', '').lower()
-
-                        # Unit conversion if needed
-                        if unit and unit.lower() != cell_unit:
-                            if unit.lower() == 'mg' and cell_unit == 'g':
-                                value = value * 1000  # Convert grams to milligrams
-
-                        return value
-                    except (ValueError, TypeError):
-                        continue
-        return None
+            row_label = (row.get('rowLabel') or '').lower()
+            cell_unit = (cells[0].get('unitOfMeasure') or '').lower()
+
+            # First matching row wins; a row may match several nutrients (e.g. "мазнини, от които наситени")
+            for match in self._NUTRIENT_PATTERN.finditer(row_label):
+                key, unit = self._NUTRIENT_BY_KEYWORD[match.group(1)]
+                if nutrition_data[key] is None:
+                    # Convert grams to milligrams if needed
+                    nutrition_data[key] = value * 1000 if unit == 'mg' and cell_unit == 'g' else value
+        return nutrition_data
 
     def extract_ingredients(self, features: List[Dict]) -> Optional[str]:
         """Extract ingredients from product features"""
@@ -235,10 +530,10 @@ class MetroProductScraper:
                 ingredient_parts = []
 
                 for leaf in leafs:
-                    meta_info = leaf.get('metaInfo', '')
-                    if meta_info in ['Contains', ''] and leaf.get('label'):
-                        label = leaf.get('label', '').strip()
-                        if label and label not in ['INGREDIENTS', '(', ')']:
+                    label = leaf.get('label')
+                    if label and leaf.get('metaInfo', '') in self._INGREDIENT_META_INFO:
+                        label = label.strip()
+                        if label and label not in self._INGREDIENT_STOPWORDS:
                             ingredient_parts.append(label)
 
                 if ingredient_parts:
@@ -248,28 +543,23 @@ class MetroProductScraper:
     def extract_product_data(self, article_data: Dict) -> Optional[Dict]:
         """Extract product data matching the OpenFoodFacts schema"""
         try:
-            # Navigate Metro's nested structure
-            variants = article_data.get('variants', {})
-            if not variants:
-                return None
-
-            # Get first variant
-            variant = list(variants.values())[0]
-            bundles = variant.get('bundles', {})
-            if not bundles:
-                return None
-
-            # Get first bundle
-            bundle = list(bundles.values())[0]
-
-            # Extract barcode (most important for your use case)
-            ean_numbers = bundle.get('eanNumber', []) or bundle.get('gtins', [])
-            code = None
-            if ean_numbers and len(ean_numbers) > 0:
-                code = ean_numbers[0].get('number')
+            # Navigate Metro's nested structure: take the first bundle, in API order across all
+            # variants, that carries a barcode (most important for your use case), so products
+            # without one are rejected before any of the heavier parsing below
+            variants = article_data.get('variants') or {}
+            bundle = next(
+                (bundle for variant in variants.values()
+                 for bundle in (variant.get('bundles') or {}).values()
+                 if bundle.get('eanNumber') or bundle.get('gtins')),
+                None
+            )
+            if bundle is None:
+                return None  # Skip products without barcodes
 
+            ean_numbers = bundle.get('eanNumber') or bundle.get('gtins')
+            code = ean_numbers[0].get('number')
             if not code:
-                return None  # Skip products without barcodes
+                return None
 
             # Extract basic info
             product_name = bundle.get('description', '')
@@ -312,22 +602,7 @@ class MetroProductScraper:
                 # Extract nutrition
                 nutrition_table = details.get('nutritionalTable', {})
                 if nutrition_table:
-                    nutrition_data = {
-                        'energy_100g': self.extract_nutritional_value(nutrition_table, ['енергийна стойност'], 'kcal'),
-                        'fat_100g': self.extract_nutritional_value(nutrition_table, ['мазнини'], 'g'),
-                        'saturated_fat_100g': self.extract_nutritional_value(nutrition_table, ['наситени'], 'g'),
-                        'proteins_100g': self.extract_nutritional_value(nutrition_table, ['белтъци'], 'g'),
-                        'carbohydrates_100g': self.extract_nutritional_value(nutrition_table, ['въглехидрати'], 'g'),
-                        'sugars_100g': self.extract_nutritional_value(nutrition_table, ['захари'], 'g'),
-                        'fiber_100g': self.extract_nutritional_value(nutrition_table, ['влакна', 'fiber'], 'g'),
-                        'sodium_100g': self.extract_nutritional_value(nutrition_table, ['sodium'], 'mg')
-                    }
-
-                    # Special handling for energy in kJ (convert to kcal if needed)
-                    if not nutrition_data.get('energy_100g'):
-                        energy_kj = self.extract_nutritional_value(nutrition_table, ['енергийна стойност'], 'kJ')
-                        if energy_kj:
-                            nutrition_data['energy_100g'] = round(energy_kj / 4.184, 1)  # Convert kJ to kcal
+                    nutrition_data = self.extract_nutrition(nutrition_table)
 
             return {
                 'code': code,
@@ -352,89 +627,112 @@ class MetroProductScraper:
             self.logger.error(f"Error extracting product data: {e}")
             return None
 
-    def scrape_all_products(self) -> List[Dict]:
-        """Main method to scrape all Metro food products"""
-        self.logger.info("Starting Metro product scraping...")
-
-        # Step 1: Get all variant IDs
-        variant_ids = self.get_all_product_variant_ids()
-        if not variant_ids:
-            self.logger.error("No product IDs found")
-            return []
-
-        # Step 2: Convert to article IDs and remove duplicates
-        article_ids = list(set(self.convert_variant_to_article_id(vid) for vid in variant_ids))
-        self.logger.info(f"Converted to {len(article_ids)} unique article IDs")
-
-        # Step 3: Fetch product details in batches
-        all_products = []
-        batch_size = 20  # Metro API can handle multiple IDs per request
-        total_batches = (len(article_ids) + batch_size - 1) // batch_size
-
-        for i in range(0, len(article_ids), batch_size):
-            batch_num = i // batch_size + 1
-            batch_ids = article_ids[i:i + batch_size]
-
-            self.logger.info(f"Processing batch {batch_num}/{total_batches} ({len(batch_ids)} products)")
+    def _open_writer(self, filename: str) -> _ProductWriter:
+        """Open the output CSV (header already written) and its Parquet copy as '.part' files"""
+        return _ProductWriter(filename, self.CSV_COLUMNS, self._METRO_SCHEMA, list(self._STAT_COLUMNS), self.logger)
 
-            # Get product details
-            batch_response = self.get_product_details_batch(batch_ids)
+    async def scrape_all_products(self, filename: str = "metro_products.csv") -> int:
+        """Main method to scrape all Metro food products, streaming them to a CSV file
 
-            if batch_response and 'result' in batch_response:
-                for article_id, article_data in batch_response['result'].items():
-                    product_data = self.extract_product_data(article_data)
-                    if product_data:
-                        all_products.append(product_data)
-                        if len(all_products) % 100 == 0:
-                            self.logger.info(f"Processed {len(all_products)} products so far...")
-            else:
-                self.logger.warning(f"Failed to get data for batch {batch_num}")
+        Returns the number of products written.
+        """
+        self.logger.info("Starting Metro product scraping...")
 
-        self.logger.info(f"Scraping completed! Total products with barcodes: {len(all_products)}")
-        return all_products
+        await self.open_session()
+        writer = self._open_writer(filename)
+        try:
+            product_count = await self._scrape_all_products(writer)
+        finally:
+            writer.close()
+            await self.close_session()
+
+        if not product_count:
+            # Keep the previous output rather than replacing it with a header-only file
+            writer.discard()
+            self.logger.error(f"No products scraped, {filename} left unchanged")
+            return 0
+
+        writer.publish()
+        self.logger.info(f"Saved {product_count} products to {filename}")
+        self.log_product_stats(writer.filled)
+        return product_count
+
+    async def _scrape_all_products(self, writer: _ProductWriter) -> int:
+        # Step 1: Get all unique article IDs, sorted so detail batches (and their cache keys) match across runs
+        article_ids = sorted(await self.get_all_article_ids())
+        if not article_ids:
+            self.logger.error("No product IDs found")
+            return 0
+
+        # Step 2: Fetch product details in batches. The first batch probes how many IDs the API
+        # returns per request; the rest are all in flight under the semaphore
+        def write_products(results: Dict[str, Dict]):
+            for article_id, article_data in results.items():
+                product_data = self.extract_product_data(article_data)
+                if product_data:
+                    writer.write(product_data)
+                    if writer.count % 100 == 0:
+                        self.logger.info(f"Processed {writer.count} products so far...")
+            # Keep partial output on disk in case the run dies
+            writer.flush()
+
+        batch_size = self.DETAILS_BATCH_SIZE
+        first_batch = self.make_details_batches(article_ids, batch_size)[0]
+        first_results = await self.get_product_details(first_batch)
+        if len(first_results) == len(first_batch) == batch_size:
+            batch_size = self.DETAILS_MAX_BATCH_SIZE
+        write_products(first_results)
+
+        batches = self.make_details_batches(article_ids[len(first_batch):], batch_size)
+        self.logger.info(f"Fetching {len(batches)} more batches of up to {batch_size} products")
+        for completed in asyncio.as_completed([self.get_product_details(batch_ids) for batch_ids in batches]):
+            write_products(await completed)
+
+        self.logger.info(f"Scraping completed! Total products with barcodes: {writer.count}")
+        return writer.count
 
     def save_to_csv(self, products: List[Dict], filename: str = "metro_products.csv"):
-        """Save products to CSV file"""
+        """Save products to CSV file, with a typed Parquet copy next to it"""
         if not products:
             self.logger.warning("No products to save")
             return
 
-        # Create DataFrame with exact schema columns
-        df = pd.DataFrame(products)
-
-        # Ensure all required columns exist
-        required_columns = [
-            'code', 'product_name', 'quantity', 'brand', 'categories',
-            'ingredients', 'image_url', 'nutriscore_grade', 'energy_100g',
-            'fat_100g', 'saturated_fat_100g', 'proteins_100g',
-            'carbohydrates_100g', 'sugars_100g', 'fiber_100g', 'sodium_100g'
-        ]
-
-        for col in required_columns:
-            if col not in df.columns:
-                df[col] = None
-
-        # Reorder columns to match schema
-        df = df[required_columns]
-
-        # Save to CSV
-        df.to_csv(filename, index=False, encoding='utf-8')
-        self.logger.info(f"Saved {len(products)} products to {filename}")
+        writer = self._open_writer(filename)
+        try:
+            for product in products:
+                writer.write(product)
+        finally:
+            writer.close()
+        writer.publish()
+        self.logger.info(f"Saved {writer.count} products to {filename}")
+        self.log_product_stats(writer.filled)
 
-        # Print some statistics
-        self.logger.info(f"Products with nutritional data: {df['energy_100g'].notna().sum()}")
-        self.logger.info(f"Products with ingredients: {df['ingredients'].notna().sum()}")
-        self.logger.info(f"Products with images: {df['image_url'].notna().sum()}")
+    def log_product_stats(self, filled: Dict[str, int]):
+        """Log coverage statistics from the non-empty value counts of a saved products file"""
+        for column, description in self._STAT_COLUMNS.items():
+            self.logger.info(f"Products with {description}: {filled[column]}")
 
 
 # Main execution
 if __name__ == "__main__":
+    # uvloop is optional: a faster event loop for dispatching thousands of short requests
+    try:
+        from uvloop import run as run_event_loop
+    except ImportError:
+        run_event_loop = asyncio.run
+
     scraper = MetroProductScraper(delay=2.0)  # 2 second delay to be respectful
 
     # Test with a small batch first (comment out to skip test)
     # print("Testing with small batch...")
     # test_ids = ['BTY-X294550', 'BTY-X334084']
-    # test_response = scraper.get_product_details_batch(test_ids)
+    # async def fetch_test_batch():
+    #     await scraper.open_session()
+    #     try:
+    #         return await scraper.get_product_details_batch(test_ids)
+    #     finally:
+    #         await scraper.close_session()
+    # test_response = asyncio.run(fetch_test_batch())
     # if test_response:
     #     test_products = []
     #     for article_id, article_data in test_response['result'].items():
@@ -446,12 +744,11 @@ if __name__ == "__main__":
 
     # Run full scrape with smaller page size to get all products
     print("Starting full Metro scrape with page size 24...")
-    products = scraper.scrape_all_products()
+    product_count = run_event_loop(scraper.scrape_all_products("metro_products_full2.csv"))
 
-    if products:
-        scraper.save_to_csv(products, "metro_products_full2.csv")
+    if product_count:
         print(f"\nScraping completed successfully!")
-        print(f"Total products: {len(products)}")
+        print(f"Total products: {product_count}")
         print(f"Data saved to: metro_products_full2.csv")
         print(f"Previous backup preserved in: metro_products_full.csv")
     else: